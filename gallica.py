@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import itertools
+import json
 import os
 import random
 import re
@@ -10,11 +12,13 @@ import sys
 import time
 import threading
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 
 # -------------------------
@@ -28,6 +32,7 @@ MAX_TRIES = 8
 
 BASE_BACKOFF = 0.6
 MAX_BACKOFF = 12.0
+MAX_RETRY_AFTER = 120.0      # plafond du Retry-After serveur (fenêtre partagée)
 
 UA = (
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
@@ -35,8 +40,6 @@ UA = (
     "Chrome/121.0 Safari/537.36"
 )
 
-_tls = threading.local()
-
 
 # -------------------------
 # URL / ARK parsing
@@ -58,7 +61,7 @@ def ark_from_url(url: str) -> str:
 # -------------------------
 # HTTP helpers
 # -------------------------
-def make_session() -> requests.Session:
+def make_session(pool_maxsize: int = DEFAULT_WORKERS) -> requests.Session:
     s = requests.Session()
     s.headers.update({
         "User-Agent": UA,
@@ -68,20 +71,24 @@ def make_session() -> requests.Session:
         "Referer": "https://gallica.bnf.fr/",
         "Origin": "https://gallica.bnf.fr",
     })
-    adapter = HTTPAdapter(pool_connections=50, pool_maxsize=50, max_retries=0)
+    # Un seul hôte: 1 pool, autant de connexions que de workers (partagé entre threads)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True, max_retries=0)
     s.mount("https://", adapter)
     s.mount("http://", adapter)
     return s
 
 
-def fetch(session: requests.Session, url: str, expect_json: bool = False, stream: bool = False) -> requests.Response:
+def fetch(session: requests.Session, url: str, stream: bool = False) -> requests.Response:
     r = session.get(url, timeout=TIMEOUT, stream=stream)
     r.raise_for_status()
-    if expect_json:
-        _ = r.json()
     return r
 
 
+def fetch_json(session: requests.Session, url: str) -> dict:
+    # Un seul parse JSON (le manifest peut peser plusieurs Mo)
+    return fetch(session, url).json()
+
+
 def warmup(session: requests.Session, ark: str) -> None:
     # Ouvre une page Gallica "viewer" pour récupérer cookies / init session
     urls = [
@@ -106,13 +113,13 @@ def manifest_url(ark: str) -> str:
     return f"https://gallica.bnf.fr/iiif/ark:/12148/{ark}/manifest.json"
 
 
+# URL absolue ou relative: un seul motif, une seule passe sur le HTML
+MANIFEST_RE = re.compile(r"(?:https://gallica\.bnf\.fr)?(/iiif/ark:/12148/[^\"']+/manifest\.json)")
+
 def extract_manifest_from_html(html: str) -> str | None:
-    m = re.search(r"https://gallica\.bnf\.fr/iiif/ark:/12148/[^\"']+/manifest\.json", html)
+    m = MANIFEST_RE.search(html)
     if m:
-        return m.group(0)
-    m = re.search(r"/iiif/ark:/12148/[^\"']+/manifest\.json", html)
-    if m:
-        return "https://gallica.bnf.fr" + m.group(0)
+        return "https://gallica.bnf.fr" + m.group(1)
     return None
 
 
@@ -121,8 +128,7 @@ def get_manifest(session: requests.Session, ark: str) -> dict:
 
     # 1) Essai direct
     try:
-        r = fetch(session, murl, expect_json=True)
-        return r.json()
+        return fetch_json(session, murl)
     except requests.HTTPError as e:
         if e.response is None:
             raise
@@ -134,8 +140,7 @@ def get_manifest(session: requests.Session, ark: str) -> dict:
         time.sleep(0.7 * attempt)
         try:
             warmup(session, ark)
-            r = fetch(session, murl, expect_json=True)
-            return r.json()
+            return fetch_json(session, murl)
         except Exception:
             pass
 
@@ -150,8 +155,7 @@ def get_manifest(session: requests.Session, ark: str) -> dict:
             rr.raise_for_status()
             alt = extract_manifest_from_html(rr.text)
             if alt:
-                r = fetch(session, alt, expect_json=True)
-                return r.json()
+                return fetch_json(session, alt)
         except Exception:
             continue
 
@@ -200,93 +204,296 @@ def canvas_image_service_id(canvas: dict) -> str:
     raise RuntimeError("Impossible de trouver le service IIIF image pour une page (structure inattendue).")
 
 
-def iiif_jpg_url(service_id: str, max_width: int) -> str:
+def canvas_width(canvas: dict) -> int | None:
+    # Largeur native de l'image (v2: resource.width). Pas celle du canvas:
+    # c'est un espace de coordonnées, pas forcément la taille en pixels.
+    imgs = canvas.get("images")
+    if imgs:
+        w = imgs[0].get("resource", {}).get("width")
+        if isinstance(w, int) and w > 0:
+            return w
+    return None
+
+
+def iiif_jpg_url(service_id: str, max_width: int, native_width: int | None = None) -> str:
     service_id = service_id.rstrip("/")
+    # Image déjà assez petite: demander la taille native, sans redimensionnement serveur
+    if native_width and max_width >= native_width:
+        return f"{service_id}/full/full/0/default.jpg"
     return f"{service_id}/full/{max_width},/0/default.jpg"
 
 
 # -------------------------
-# Download with backoff
+# Manifest cache (dossier de travail)
 # -------------------------
-def thread_session(cookies: dict) -> requests.Session:
-    if not hasattr(_tls, "session"):
-        _tls.session = make_session()
-        if cookies:
-            _tls.session.cookies.update(cookies)
-    return _tls.session
+MANIFEST_CACHE = ".manifest_cache.json"
+
+
+def load_page_urls(cache_path: Path, ark: str, max_width: int) -> list[str] | None:
+    # URLs des pages d'un run précédent, si même ARK et même --max-width
+    try:
+        data = json.loads(cache_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("ark") != ark or data.get("max_width") != max_width:
+        return None
+    urls = data.get("urls")
+    if not isinstance(urls, list) or not urls or not all(isinstance(u, str) for u in urls):
+        return None
+    return urls
+
+
+def save_page_urls(cache_path: Path, ark: str, max_width: int, urls: list[str]) -> None:
+    tmp = cache_path.with_suffix(cache_path.suffix + ".part")
+    tmp.write_text(json.dumps({"ark": ark, "max_width": max_width, "urls": urls}), encoding="utf-8")
+    os.replace(tmp, cache_path)
 
 
-def download_with_backoff(url: str, out_path: Path, cookies: dict, sleep: float) -> None:
-    # skip si déjà ok
-    if out_path.exists() and out_path.stat().st_size > 50_000:
+# -------------------------
+# Page cache hints (Linux)
+# -------------------------
+def drop_from_cache(f) -> None:
+    # Page écrite une fois, relue une fois à l'assemblage: inutile de la garder
+    # en cache. DONTNEED ignore les pages sales, donc on synchronise d'abord
+    # (ce qui rend aussi le os.replace qui suit sûr en cas de crash).
+    # No-op hors Linux.
+    if not hasattr(os, "posix_fadvise"):
         return
+    f.flush()
+    try:
+        os.fdatasync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
 
-    s = thread_session(cookies)
 
-    base = BASE_BACKOFF
-    for attempt in range(1, MAX_TRIES + 1):
-        r = s.get(url, stream=True, timeout=TIMEOUT)
+# -------------------------
+# Download with backoff
+# -------------------------
+# Fenêtre de backoff partagée: quand un worker se fait throttler, les autres
+# attendent aussi au lieu de découvrir le 429 chacun de leur côté.
+_throttle_lock = threading.Lock()
+_throttle_until = 0.0
+
+
+def backoff_delay(attempt: int) -> float:
+    # "Full jitter": tirage uniforme sur [0, cap] pour désynchroniser les workers
+    cap = min(MAX_BACKOFF, BASE_BACKOFF * (1 << (attempt - 1)))
+    return random.uniform(0, cap)
+
+
+def retry_after(r: requests.Response) -> float | None:
+    # Retry-After: soit un nombre de secondes, soit une date HTTP.
+    # Plafonné: la fenêtre est partagée, un "86400" bloquerait tous les workers.
+    ra = (r.headers.get("Retry-After") or "").strip()
+    if not ra:
+        return None
+    if ra.isdigit():
+        delay = float(ra)
+    else:
+        try:
+            delay = max(0.0, parsedate_to_datetime(ra).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    return min(delay, MAX_RETRY_AFTER)
 
-        if r.status_code == 200:
-            tmp = out_path.with_suffix(out_path.suffix + ".part")
-            with open(tmp, "wb") as f:
-                for chunk in r.iter_content(chunk_size=1024 * 256):
-                    if chunk:
-                        f.write(chunk)
-            os.replace(tmp, out_path)
-            if sleep and sleep > 0:
-                time.sleep(sleep)
-            return
 
-        if r.status_code in (403, 429, 503):
-            wait = base * (2 ** (attempt - 1)) + random.uniform(0, 0.35)
-            time.sleep(min(wait, MAX_BACKOFF))
-            continue
+def note_throttle(delay: float) -> None:
+    global _throttle_until
+    with _throttle_lock:
+        _throttle_until = max(_throttle_until, time.monotonic() + delay)
+
 
-        r.raise_for_status()
+def wait_throttle() -> None:
+    with _throttle_lock:
+        remaining = _throttle_until - time.monotonic()
+    if remaining > 0:
+        # petit jitter pour ne pas repartir tous au même instant
+        time.sleep(remaining + random.uniform(0, BASE_BACKOFF))
+
+
+def is_complete_jpeg(path: Path) -> bool:
+    # Marqueurs SOI (début) et EOI (fin): détecte les fichiers tronqués
+    try:
+        with open(path, "rb") as fh:
+            if fh.read(2) != b"\xff\xd8":
+                return False
+            fh.seek(-2, os.SEEK_END)
+            return fh.read(2) == b"\xff\xd9"
+    except OSError:
+        return False
+
+
+def part_meta(tmp: Path) -> Path:
+    return tmp.with_suffix(tmp.suffix + ".json")
+
+
+def discard_part(tmp: Path) -> None:
+    tmp.unlink(missing_ok=True)
+    part_meta(tmp).unlink(missing_ok=True)
+
+
+def resume_point(tmp: Path, url: str) -> tuple[int, str | None]:
+    # Un .part n'est repris que s'il vient de la même URL (même --max-width,
+    # même dérivé IIIF); sinon on le jette pour ne pas raccorder deux images.
+    if not tmp.exists():
+        return 0, None
+    try:
+        meta = json.loads(part_meta(tmp).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        meta = None
+    if not isinstance(meta, dict) or meta.get("url") != url:
+        discard_part(tmp)
+        return 0, None
+    return tmp.stat().st_size, meta.get("validator")
+
+
+def save_part_meta(tmp: Path, url: str, r: requests.Response) -> None:
+    # Validateur pour If-Range: ETag fort de préférence, sinon Last-Modified
+    etag = r.headers.get("ETag")
+    validator = etag if etag and not etag.startswith("W/") else r.headers.get("Last-Modified")
+    part_meta(tmp).write_text(json.dumps({"url": url, "validator": validator}), encoding="utf-8")
+
+
+def download_with_backoff(url: str, out_path: Path, session: requests.Session, sleep: float) -> None:
+    tmp = out_path.with_suffix(out_path.suffix + ".part")
+
+    for attempt in range(1, MAX_TRIES + 1):
+        wait_throttle()
+
+        # Reprise: si un .part de la même URL existe, on ne demande que la suite.
+        # If-Range: si l'image a changé, le serveur renvoie 200 (image complète).
+        start, validator = resume_point(tmp, url)
+        headers = None
+        if start:
+            headers = {"Range": f"bytes={start}-"}
+            if validator:
+                headers["If-Range"] = validator
+        # with: la connexion revient au pool quelle que soit la sortie (pool_block=True)
+        with session.get(url, stream=True, timeout=TIMEOUT, headers=headers) as r:
+            if r.status_code == 206 and not r.headers.get("Content-Range", "").startswith(f"bytes {start}-"):
+                # Plage inattendue: on repart de zéro
+                discard_part(tmp)
+                continue
+
+            if r.status_code == 416:
+                # .part incohérent avec l'image distante: on repart de zéro
+                discard_part(tmp)
+                continue
+
+            if r.status_code in (200, 206):
+                # 200 = image complète (Range ignoré), 206 = suite du .part
+                mode = "ab" if r.status_code == 206 else "wb"
+                if r.status_code == 200:
+                    save_part_meta(tmp, url, r)
+                # gzip/deflate éventuel décodé par urllib3. Petits blocs: sur coupure,
+                # urllib3 perd le bloc en cours, le .part garde tout le reste.
+                r.raw.decode_content = True
+                try:
+                    with open(tmp, mode) as f:
+                        shutil.copyfileobj(r.raw, f, length=64 * 1024)
+                        drop_from_cache(f)
+                except (ProtocolError, ReadTimeoutError):
+                    # Coupure en cours de corps: le .part sera repris au prochain essai
+                    r.close()
+                    time.sleep(backoff_delay(attempt))
+                    continue
+                os.replace(tmp, out_path)
+                part_meta(tmp).unlink(missing_ok=True)
+                if sleep and sleep > 0:
+                    time.sleep(sleep)
+                return
+
+            if r.status_code in (403, 429, 503):
+                # Le serveur sait mieux que nous combien attendre
+                delay = retry_after(r)
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                # pool_block=True: rendre la connexion au pool avant de dormir
+                r.close()
+                note_throttle(delay)
+                time.sleep(delay)
+                continue
+
+            r.raise_for_status()
 
     raise RuntimeError(f"Echec téléchargement après {MAX_TRIES} essais: {url}")
 
 
-def parallel_download(jobs, workers: int, cookies: dict, sleep: float) -> None:
+def parallel_download(jobs, workers: int, session: requests.Session, sleep: float) -> None:
     total = len(jobs)
     if total == 0:
         return
 
-    done = 0
+    # Première page seule: ouvre la connexion keep-alive et révèle un éventuel
+    # blocage (403/429) avant de lancer tous les workers dessus.
+    url, out_path = jobs[0]
+    download_with_backoff(url, out_path, session, sleep)
+    done = 1
+    if done == total:
+        print(f"Téléchargées: {done}/{total}")
+        return
+
+    # Soumission bornée: au plus 2*workers futures en vol
+    pending_jobs = iter(jobs[1:])
     with ThreadPoolExecutor(max_workers=workers) as ex:
-        futs = [
-            ex.submit(download_with_backoff, url, out_path, cookies, sleep)
-            for (url, out_path) in jobs
-        ]
-        for _ in as_completed(futs):
-            done += 1
-            if done % 25 == 0 or done == total:
-                print(f"Téléchargées: {done}/{total}")
+        futs = {
+            ex.submit(download_with_backoff, url, out_path, session, sleep)
+            for (url, out_path) in itertools.islice(pending_jobs, workers * 2)
+        }
+        while futs:
+            finished, futs = wait(futs, return_when=FIRST_COMPLETED)
+            for _ in finished:
+                done += 1
+                if done % 25 == 0 or done == total:
+                    print(f"Téléchargées: {done}/{total}")
+            for (url, out_path) in itertools.islice(pending_jobs, len(finished)):
+                futs.add(ex.submit(download_with_backoff, url, out_path, session, sleep))
 
 
 # -------------------------
 # PDF assembly
 # -------------------------
 def assemble_pdf(images: list[Path], out_pdf: Path) -> None:
-    # Essai img2pdf (recommandé)
+    # img2pdf (recommandé): embarque les JPEG tels quels, sans ré-encodage.
+    # Seule son absence déclenche le fallback; toute autre erreur remonte.
     try:
         import img2pdf
-        with open(out_pdf, "wb") as f:
-            f.write(img2pdf.convert([str(p) for p in images]))
+    except ImportError:
+        img2pdf = None
+
+    # Écriture dans un .part puis os.replace: un assemblage interrompu ne laisse
+    # jamais un out_pdf tronqué (que le test "PDF déjà à jour" croirait valide).
+    # En cas d'échec le .part est supprimé: il est hors du dossier de travail.
+    tmp = out_pdf.with_suffix(out_pdf.suffix + ".part")
+
+    if img2pdf is not None:
+        try:
+            with open(tmp, "wb") as f:
+                img2pdf.convert([str(p) for p in images], outputstream=f)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        os.replace(tmp, out_pdf)
         return
-    except Exception:
-        pass
 
-    # Fallback Pillow
+    # Fallback Pillow (ré-encode: uniquement si img2pdf n'est pas installé)
     try:
         from PIL import Image
-        pil_images = []
-        for p in images:
-            im = Image.open(p).convert("RGB")
-            pil_images.append(im)
+
+        def decode(p: Path):
+            return Image.open(p).convert("RGB")
+
+        # libjpeg relâche le GIL: décodage en parallèle, ordre conservé par map()
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as ex:
+            pil_images = list(ex.map(decode, images))
         first, rest = pil_images[0], pil_images[1:]
-        first.save(out_pdf, save_all=True, append_images=rest)
+        try:
+            first.save(tmp, format="PDF", save_all=True, append_images=rest)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        os.replace(tmp, out_pdf)
         return
     except Exception as e:
         raise RuntimeError(
@@ -382,7 +589,8 @@ def main():
 
     img_dir.mkdir(parents=True, exist_ok=True)
 
-    master = make_session()
+    # Session unique partagée par tous les workers (cookies du warmup inclus)
+    master = make_session(pool_maxsize=max(1, args.workers))
 
     print("0) Warmup (page Gallica pour cookies)…")
     try:
@@ -390,41 +598,54 @@ def main():
     except Exception as e:
         print(f"⚠️ Warmup non bloquant (erreur: {e})")
 
-    print("1) Téléchargement manifest…")
-    manifest = get_manifest(master, ark)
+    cache_path = workdir / MANIFEST_CACHE
+    urls = load_page_urls(cache_path, ark, args.max_width)
+    if urls is not None:
+        print("1) Manifest en cache (run précédent), pas de téléchargement.")
+    else:
+        print("1) Téléchargement manifest…")
+        manifest = get_manifest(master, ark)
 
-    canvases = list(iter_canvases(manifest))
-    if not canvases:
-        raise RuntimeError("Aucune page trouvée dans le manifest (structure inattendue).")
+        canvases = list(iter_canvases(manifest))
+        del manifest  # on ne garde que les canvases
+        if not canvases:
+            raise RuntimeError("Aucune page trouvée dans le manifest (structure inattendue).")
 
-    print(f"2) {len(canvases)} pages détectées.")
+        urls = [
+            iiif_jpg_url(canvas_image_service_id(c), max_width=args.max_width, native_width=canvas_width(c))
+            for c in canvases
+        ]
+        save_page_urls(cache_path, ark, args.max_width, urls)
 
-    cookies = master.cookies.get_dict()
+    print(f"2) {len(urls)} pages détectées.")
 
-    # Build jobs
+    # Build jobs (un seul scandir au lieu de exists()+stat() par page)
+    present = {e.name: e.stat().st_size for e in os.scandir(img_dir) if e.is_file()}
     jobs = []
-    for i, canvas in enumerate(canvases, start=1):
-        out_img = img_dir / f"page_{i:04d}.jpg"
-        if out_img.exists() and out_img.stat().st_size > 50_000:
+    for i, url in enumerate(urls, start=1):
+        name = f"page_{i:04d}.jpg"
+        if present.get(name, 0) > 50_000 and is_complete_jpeg(img_dir / name):
             continue
-        sid = canvas_image_service_id(canvas)
-        url = iiif_jpg_url(sid, max_width=args.max_width)
-        jobs.append((url, out_img))
+        jobs.append((url, img_dir / name))
 
-    print(f"3) Pages à télécharger: {len(jobs)} (déjà présentes: {len(canvases) - len(jobs)})")
+    print(f"3) Pages à télécharger: {len(jobs)} (déjà présentes: {len(urls) - len(jobs)})")
     if jobs:
         print(f"   → workers={args.workers} sleep={args.sleep} max_width={args.max_width}")
-        parallel_download(jobs, workers=args.workers, cookies=cookies, sleep=args.sleep)
+        parallel_download(jobs, workers=args.workers, session=master, sleep=args.sleep)
 
     # Assemble PDF
     print("4) Assemblage PDF…")
-    images = [img_dir / f"page_{i:04d}.jpg" for i in range(1, len(canvases) + 1)]
+    images = [img_dir / f"page_{i:04d}.jpg" for i in range(1, len(urls) + 1)]
     missing = [p for p in images if not p.exists()]
     if missing:
         raise RuntimeError(f"Il manque {len(missing)} images (ex: {missing[0]}). Relance le script.")
 
-    assemble_pdf(images, out_pdf)
-    print(f"✅ PDF généré: {out_pdf.resolve()}")
+    # PDF plus récent que toutes les images: rien à réassembler
+    if out_pdf.exists() and out_pdf.stat().st_mtime >= max(p.stat().st_mtime for p in images):
+        print(f"PDF déjà à jour: {out_pdf.resolve()}")
+    else:
+        assemble_pdf(images, out_pdf)
+        print(f"✅ PDF généré: {out_pdf.resolve()}")
 
     # Cleanup by default
     if not args.keep: